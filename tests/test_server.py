@@ -0,0 +1,192 @@
+import asyncio
+import os
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("TWELVELABS_API_KEY", "test")
+
+from twelvelabs_mcp import server
+
+
+@pytest.fixture
+def ffmpeg(monkeypatch):
+    """Stub ffmpeg; clips ending in fail make it exit 1, ones in empty stay empty"""
+    calls = []
+    fail = set()
+    empty = set()
+
+    async def run_ffmpeg(cmd):
+        calls.append(cmd)
+        outputs = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "copy"]
+        ends = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-to"]
+        seek = float(cmd[cmd.index("-i") - 1])
+        if any(seek + float(end) in fail for end in ends):
+            return 1, b"bad range"
+        for output, end in zip(outputs, ends):
+            Path(output).write_bytes(b"" if seek + float(end) in empty else b"x")
+        return 0, b""
+
+    monkeypatch.setattr(server, "run_ffmpeg", run_ffmpeg)
+    monkeypatch.setattr(server, "ffmpeg_bin", "ffmpeg")
+    return calls, fail, empty
+
+
+def make_clips(tmp_path, ranges):
+    return [
+        {"index": i, "start": start, "end": end, "path": str(tmp_path / f"{i}.mp4")}
+        for i, (start, end) in enumerate(ranges)
+    ]
+
+
+def test_batch_clips_splits_on_large_gaps():
+    clips = [
+        {"start": 100, "end": 105},
+        {"start": 10, "end": 15},
+        {"start": 40, "end": 45},
+        {"start": 20, "end": 60},
+    ]
+    batches = server._batch_clips(clips)
+    assert [[clip["start"] for clip in batch] for batch in batches] == [
+        [10, 20, 40],
+        [100],
+    ]
+
+
+def test_cut_hls_clips_seeks_input_to_first_clip(tmp_path, ffmpeg):
+    calls, _, _ = ffmpeg
+    clips = make_clips(tmp_path, [(10, 15), (20, 33)])
+    cut = asyncio.run(server._cut_hls_clips("https://x/v.m3u8", clips))
+
+    assert cut == clips
+    assert all(Path(clip["path"]).read_bytes() == b"x" for clip in clips)
+    cmd = calls[0]
+    assert cmd[cmd.index("-i") - 2 : cmd.index("-i")] == ["-ss", "10"]
+    outputs = cmd[cmd.index("-i") + 2 :]
+    # The first clip starts at the input seek, so it gets no output seek
+    assert outputs[:4] == ["-to", "5", "-c", "copy"]
+    assert outputs[5:9] == ["-ss", "10", "-to", "23"]
+    # Nothing is left behind under a temporary name
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["0.mp4", "1.mp4"]
+
+
+def test_cut_hls_clips_retries_clips_after_failed_pass(tmp_path, ffmpeg):
+    calls, fail, _ = ffmpeg
+    fail.add(33)
+    clips = make_clips(tmp_path, [(10, 15), (20, 33), (40, 45)])
+    cut = asyncio.run(server._cut_hls_clips("https://x/v.m3u8", clips))
+
+    assert [clip["index"] for clip in cut] == [0, 2]
+    assert len(calls) == 4
+    assert not Path(clips[1]["path"]).exists()
+
+
+def test_cut_hls_clips_retries_empty_outputs(tmp_path, ffmpeg):
+    calls, _, empty = ffmpeg
+    empty.add(15)
+    clips = make_clips(tmp_path, [(10, 15), (20, 33)])
+    cut = asyncio.run(server._cut_hls_clips("https://x/v.m3u8", clips))
+
+    assert [clip["index"] for clip in cut] == [1]
+    # Only the clip that came out empty is cut again
+    assert len(calls) == 2
+    assert not Path(clips[0]["path"]).exists()
+
+
+def test_flatten_clips_handles_grouped_results():
+    data = [
+        {"video_id": "a", "start": 0, "end": 1},
+        {"id": "b", "clips": [{"video_id": "b", "start": 2, "end": 3}] * 3},
+        {"id": "c", "clips": None},
+    ]
+    assert len(server._flatten_clips(data, 3)) == 3
+    assert len(server._flatten_clips(data, 10)) == 4
+    assert server._flatten_clips(data, -1) == []
+
+
+def test_download_tools_report_missing_base_path(monkeypatch):
+    monkeypatch.setattr(server, "HOST_DIR", None)
+    video_info = {"hls": {"video_url": "https://x/v.m3u8"}}
+    for call in (
+        server.download_clips(1, {"data": []}, video_info),
+        server.search_and_download("index", "query"),
+    ):
+        result = asyncio.run(call)
+        assert result["status"] == "error"
+        assert "TWELVELABS_MCP_BASE_PATH" in result["message"]
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    host_dir = tmp_path / "out"
+    cache_dir = host_dir / ".twelvelabs_cache"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setattr(server, "HOST_DIR", host_dir)
+    monkeypatch.setattr(server, "CACHE_DIR", cache_dir)
+    return host_dir, cache_dir
+
+
+def search_clips(video_id, ranges):
+    return [
+        (i, {"video_id": video_id, "start": start, "end": end})
+        for i, (start, end) in enumerate(ranges)
+    ]
+
+
+def test_download_hls_clips_reuses_cache_across_urls(dirs, ffmpeg):
+    host_dir, cache_dir = dirs
+    calls, _, _ = ffmpeg
+    clips = search_clips("v", [(10, 15), (20, 25)])
+
+    downloaded, failed = asyncio.run(
+        server._download_hls_clips("https://x/v.m3u8?sig=1", "v", clips)
+    )
+    assert len(downloaded) == 2 and not failed
+    assert len(calls) == 1
+    assert len(list(cache_dir.iterdir())) == 2
+
+    # A fresh URL for the same video is served from the cache without ffmpeg
+    downloaded, failed = asyncio.run(
+        server._download_hls_clips("https://x/v.m3u8?sig=2", "v", clips)
+    )
+    assert len(downloaded) == 2 and not failed
+    assert len(calls) == 1
+    assert all(Path(clip["path"]).read_bytes() == b"x" for clip in downloaded)
+
+
+def test_download_hls_clips_caches_existing_outputs(dirs, ffmpeg):
+    _, cache_dir = dirs
+    clips = search_clips("v", [(10, 15)])
+    asyncio.run(server._download_hls_clips("https://x/v.m3u8", "v", clips))
+    for path in cache_dir.iterdir():
+        path.unlink()
+
+    asyncio.run(server._download_hls_clips("https://x/v.m3u8", "v", clips))
+    assert len(list(cache_dir.iterdir())) == 1
+
+
+def test_download_hls_clips_skips_cache_for_other_videos(dirs, ffmpeg):
+    _, cache_dir = dirs
+    clips = search_clips("other", [(10, 15)])
+    downloaded, _ = asyncio.run(
+        server._download_hls_clips("https://x/v.m3u8", "v", clips)
+    )
+    assert len(downloaded) == 1
+    assert not list(cache_dir.iterdir())
+
+
+def test_prune_cache_evicts_least_recently_used(dirs, monkeypatch):
+    _, cache_dir = dirs
+    monkeypatch.setattr(server, "CACHE_MAX_BYTES", 2)
+    for age, name in enumerate(["new", "mid", "old"]):
+        path = cache_dir / f"{name}.mp4"
+        path.write_bytes(b"x")
+        os.utime(path, (1000 - age, 1000 - age))
+    (cache_dir / ".old.part.mp4").write_bytes(b"x")
+
+    server._prune_cache()
+    assert sorted(path.name for path in cache_dir.iterdir()) == [
+        ".old.part.mp4",
+        "mid.mp4",
+        "new.mp4",
+    ]
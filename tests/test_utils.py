@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+
+from twelvelabs_mcp import utils
+from twelvelabs_mcp.utils import _segment_plan, run_ffmpeg
+
+
+def test_segment_plan_skips_gaps():
+    times, targets = _segment_plan([(10, 15, "a"), (20, 25, "b")])
+    assert times == [10, 15, 20, 25]
+    # Segments 0 and 2 are the gaps before and between the clips
+    assert targets == [(1, "a"), (3, "b")]
+
+
+def test_segment_plan_range_at_zero():
+    times, targets = _segment_plan([(0, 5, "a"), (8, 12, "b")])
+    assert times == [5, 8, 12]
+    assert targets == [(0, "a"), (2, "b")]
+
+
+def test_segment_plan_adjacent_ranges():
+    times, targets = _segment_plan([(10, 15, "a"), (15, 20, "b"), (20, 30, "c")])
+    assert times == [10, 15, 20, 30]
+    assert targets == [(1, "a"), (2, "b"), (3, "c")]
+
+
+def test_segment_plan_single_range():
+    times, targets = _segment_plan([(3.5, 7.25, "a")])
+    assert times == [3.5, 7.25]
+    assert targets == [(1, "a")]
+
+
+def test_run_ffmpeg_kills_process_on_cancel(tmp_path):
+    pid_file = tmp_path / "pid"
+    cmd = [
+        sys.executable,
+        "-c",
+        f"import os, time; open({str(pid_file)!r}, 'w').write(str(os.getpid())); "
+        "time.sleep(30)",
+    ]
+
+    async def cancel_run():
+        task = asyncio.create_task(run_ffmpeg(cmd))
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_run())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+def test_get_video_url_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(utils, "VIDEO_URL_CACHE_SIZE", 2)
+    monkeypatch.setattr(utils, "_video_urls", OrderedDict())
+    utils.get_video_url("index", "a")
+    utils.get_video_url("index", "b")
+    utils.get_video_url("index", "a")
+    utils.get_video_url("index", "c")
+    assert list(utils._video_urls) == [("index", "a"), ("index", "c")]
+
+
+def test_get_video_url_expires_entries(monkeypatch):
+    monkeypatch.setattr(utils, "_video_urls", OrderedDict())
+    utils.get_video_url("index", "a")
+    expiry, _ = utils._video_urls[("index", "a")]
+    monkeypatch.setattr(utils.time, "monotonic", lambda: expiry + 1)
+    utils.get_video_url("index", "a")
+    assert utils._video_urls[("index", "a")][0] == expiry + 1 + utils.VIDEO_URL_TTL
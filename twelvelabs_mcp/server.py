@@ -3,22 +3,77 @@ from mcp.server.fastmcp import FastMCP
 from twelvelabs import TwelveLabs, models
 import os
 from dotenv import load_dotenv
-import subprocess
-import uuid
+import asyncio
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from functools import lru_cache
+from itertools import chain, islice
+import shutil
 from pathlib import Path
 
+try:
+    from .utils import ffmpeg_input_options, run_ffmpeg, temp_path
+except ImportError:
+    # Run as a script (python server.py / mcp run server.py) rather than a package
+    from utils import ffmpeg_input_options, run_ffmpeg, temp_path
 
 # init
 load_dotenv()
+logger = logging.getLogger(__name__)
 mcp = FastMCP("twelvelabs")
 api_key = os.environ.get("TWELVELABS_API_KEY")
-print(f"api_key: {api_key}")
 if not api_key:
     raise ValueError("TWELVELABS_API_KEY is required")
-client = TwelveLabs(api_key=api_key, version="v1.3")
-# check that we have configured a client
-if not client:
-    raise ValueError("TwelveLabs client not configured")
+
+
+@lru_cache(maxsize=None)
+def get_client() -> TwelveLabs:
+    """Return the shared TwelveLabs client, creating it on first use"""
+    # The SDK keeps one pooled httpx.Client per instance, so sharing a single
+    # instance reuses its keep-alive connections across tool calls
+    return TwelveLabs(api_key=api_key, version="v1.3")
+
+
+# Output directory for downloaded clips, resolved once rather than per call
+HOST_DIR: Optional[Path] = None
+CACHE_DIR: Optional[Path] = None
+# Why the output directory couldn't be created; reported by the download tools
+# so the other tools keep working
+HOST_DIR_ERROR: Optional[str] = None
+if base_path := os.environ.get("TWELVELABS_MCP_BASE_PATH"):
+    # Properly handle tilde expansion to get absolute path
+    HOST_DIR = Path(os.path.abspath(os.path.expanduser(base_path)))
+    # Finished clips keyed by (video_id, start, end), reused across calls. It
+    # lives in a hidden subdirectory on the same filesystem so clips can be
+    # hard-linked in and out of it instead of copied
+    CACHE_DIR = HOST_DIR / ".twelvelabs_cache"
+    try:
+        CACHE_DIR.mkdir(exist_ok=True, parents=True)
+    except OSError as e:
+        HOST_DIR_ERROR = f"Could not create output directory {HOST_DIR}: {e}"
+        logger.error(HOST_DIR_ERROR)
+
+# Size limit for the clip cache; the least recently used clips are evicted
+# first. Evicted clips stay in the output directory until the user deletes them
+CACHE_MAX_BYTES = int(os.environ.get("TWELVELABS_MCP_CACHE_MAX_BYTES") or 2 * 1024**3)
+
+# Clips starting within this many seconds of the previous clip's end are cut
+# in the same ffmpeg pass; for larger gaps a separate input seek is cheaper
+# than downloading the segments in between
+CLIP_BATCH_MAX_GAP = 30.0
+
+# Cap on concurrently running tool calls, so bursts of MCP requests queue
+# instead of all hitting the API and ffmpeg at once. Unset, zero or negative
+# values fall back to the default, as a zero-sized semaphore would hang every call
+max_concurrency = (
+    max(int(os.environ.get("TWELVELABS_MCP_MAX_CONCURRENCY") or 0), 0) or 16
+)
+_TOOL_SEM = asyncio.Semaphore(max_concurrency)
+
+# Resolve ffmpeg once at startup rather than on every download
+ffmpeg_bin = shutil.which("ffmpeg")
 
 
 @mcp.resource("config://app")
@@ -44,18 +99,34 @@ def get_config() -> dict:
             index_id: The unique identifier of the index containing the video
             id: The unique identifier of the video to retrieve
         Returns:
-            A dictionary containing the video details including metadata, status, and URLs
+            A JSON object containing the video details including metadata, status, and URLs
         """
 )
-async def retrieve_video(index_id: str, id: str) -> dict:
-    try:
-        video_info: models.Video = client.index.video.retrieve(index_id, id)
-        return video_info.model_dump()
-    except Exception as e:
-        print(f"Error in retrieve_video: {e}")
-        import traceback
+async def retrieve_video(index_id: str, id: str) -> str:
+    async with _TOOL_SEM:
+        try:
+            video_info: models.Video = await asyncio.to_thread(
+                get_client().index.video.retrieve, index_id, id
+            )
+            # Serialize straight to JSON in pydantic-core instead of building a
+            # dict that FastMCP would then encode again
+            return video_info.model_dump_json()
+        except Exception as e:
+            logger.exception("Error in retrieve_video: %s", e)
+            return json.dumps({"status": "error", "message": str(e)})
+
+
+@lru_cache(maxsize=128)
+def _parse_filter(filter: str) -> dict:
+    """Parse a JSON filter string once; repeated searches reuse the dict"""
+    # The SDK JSON-encodes the filter itself, so it must be given a dict
+    return json.loads(filter)
+
 
-        traceback.print_exc()
+@lru_cache(maxsize=128)
+def _canonical_options(options: tuple[str, ...]) -> list[str]:
+    """Return search options de-duplicated, keeping their order"""
+    return list(dict.fromkeys(options))
 
 
 @mcp.tool(
@@ -89,144 +160,438 @@ async def search(
     page_limit: Optional[int] = 10,
     filter: Optional[str] = None,
     num_clips: Optional[int] = 5,
-) -> dict:
-    try:
-        params = {"index_id": index_id}
-
-        # Add required query parameters
-        if query_text:
-            params["query_text"] = query_text
-        if query_media_url:
-            params["query_media_url"] = query_media_url
-            params["query_media_type"] = query_media_type
-        if options:
-            params["options"] = options
-
-        # Add optional parameters if provided
-        if adjust_confidence_level is not None:
-            params["adjust_confidence_level"] = adjust_confidence_level
-        if group_by:
-            params["group_by"] = group_by
-        if threshold:
-            params["threshold"] = threshold
-        if sort_option:
-            params["sort_option"] = sort_option
-        if operator:
-            params["operator"] = operator
-        if page_limit:
-            params["page_limit"] = page_limit
-        if filter:
-            params["filter"] = filter
-
-        results: models.SearchResult = client.search.query(**params)
-
-        return results.model_dump()
-    except Exception as e:
-        print(f"Error in search: {e}")
-        import traceback
-
-        traceback.print_exc()
-        return {"status": "error", "message": str(e)}
-
-
-@mcp.tool(
-    description="""Download clips from a TwelveLabs search result, using the mcp_tool @retrieve_video and @search results
-    """
-)
-async def download_clips(num_clips: int, search_result: dict, video_info: dict) -> dict:
-    # Get host directory from environment variables
-    host_dir = os.environ.get("TWELVELABS_MCP_BASE_PATH")
-    if not host_dir:
-        raise ValueError("TWELVELABS_MCP_BASE_PATH environment variable is required")
+) -> str:
+    async with _TOOL_SEM:
+        try:
+            params = {"index_id": index_id}
+
+            # Add required query parameters
+            if query_text:
+                params["query_text"] = query_text
+            if query_media_url:
+                params["query_media_url"] = query_media_url
+                params["query_media_type"] = query_media_type
+            if options:
+                params["options"] = _canonical_options(tuple(options))
+
+            # Add optional parameters if provided
+            if adjust_confidence_level is not None:
+                params["adjust_confidence_level"] = adjust_confidence_level
+            if group_by:
+                params["group_by"] = group_by
+            if threshold:
+                params["threshold"] = threshold
+            if sort_option:
+                params["sort_option"] = sort_option
+            if operator:
+                params["operator"] = operator
+            if page_limit:
+                params["page_limit"] = page_limit
+            if filter:
+                params["filter"] = _parse_filter(filter)
+
+            results: models.SearchResult = await asyncio.to_thread(
+                get_client().search.query, **params
+            )
 
-    # Properly handle tilde expansion to get absolute path
-    host_dir = os.path.abspath(os.path.expanduser(host_dir))
-    host_dir = Path(host_dir)
-    print(f"Using output directory: {host_dir}")
-    host_dir.mkdir(exist_ok=True, parents=True)
+            return results.model_dump_json()
+        except Exception as e:
+            logger.exception("Error in search: %s", e)
+            return json.dumps({"status": "error", "message": str(e)})
 
-    # Get m3u8 URL from video_info
-    if not video_info.get("hls") or not video_info["hls"].get("video_url"):
-        return {"status": "error", "message": "No HLS video URL found in video_info"}
 
-    m3u8_url = video_info["hls"]["video_url"]
+def _flatten_clips(clips_data: list, num_clips: int) -> list[dict]:
+    """Take up to num_clips clips from clip or video-grouped search result data"""
+    # Handle both clip results and video-grouped results (GroupByVideoSearchData),
+    # taking only as many clips as were requested
+    flat_clips = chain.from_iterable(
+        (item.get("clips") or []) if "clips" in item else [item] for item in clips_data
+    )
+    return list(islice(flat_clips, max(num_clips, 0)))
 
-    # Process search results
-    clips_data = search_result.get("data", [])
-    downloaded_clips = []
 
-    # Handle different result structures (clip or video grouping)
-    processed_clips = []
-
-    # Check if results are grouped by video
-    if clips_data and isinstance(clips_data[0], dict) and "clips" in clips_data[0]:
-        # Handle GroupByVideoSearchData format
-        for group in clips_data:
-            if group.get("clips"):
-                processed_clips.extend(group["clips"][:num_clips])
-                if len(processed_clips) >= num_clips:
-                    break
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """Hard-link src to dst, copying instead where links aren't supported"""
+    # Build the file under a temporary name so dst never appears half-written
+    partial_path = temp_path(dst)
+    try:
+        try:
+            os.link(src, partial_path)
+        except OSError:
+            shutil.copyfile(src, partial_path)
+        os.replace(partial_path, dst)
+    finally:
+        partial_path.unlink(missing_ok=True)
+
+
+def _is_complete(path: Path) -> bool:
+    """Return True if path is a non-empty file"""
+    return path.exists() and path.stat().st_size > 0
+
+
+def _batch_clips(clips: list[dict]) -> list[list[dict]]:
+    """Group clips into batches close enough together to cut in one ffmpeg pass"""
+    batches = []
+    batch_end = None
+    for clip in sorted(clips, key=lambda clip: clip["start"]):
+        if batch_end is None or clip["start"] - batch_end > CLIP_BATCH_MAX_GAP:
+            batches.append([])
+            batch_end = clip["end"]
+        batches[-1].append(clip)
+        batch_end = max(batch_end, clip["end"])
+    return batches
+
+
+async def _cut_hls_clips(m3u8_url: str, clips: list[dict]) -> list[dict]:
+    """Cut nearby clips from an HLS stream in one ffmpeg pass, returning those cut"""
+    # Seek the input to the earliest clip so ffmpeg jumps straight to its
+    # segment; every output range is then relative to that point
+    seek = min(clip["start"] for clip in clips)
+    cmd = [
+        ffmpeg_bin,
+        "-y",
+        *ffmpeg_input_options(m3u8_url),
+        "-ss",
+        str(seek),
+        "-i",
+        m3u8_url,
+    ]
+    # ffmpeg writes to unique temporary files that are renamed into place only
+    # once complete, so concurrent, failed or cancelled calls never leave a
+    # partial file at a path that later calls treat as finished
+    temp_paths = {clip["path"]: temp_path(Path(clip["path"])) for clip in clips}
+    for clip in clips:
+        # An output seek of 0 would drop the keyframe the input seek landed on
+        if clip["start"] > seek:
+            cmd.extend(["-ss", str(clip["start"] - seek)])
+        partial_path = str(temp_paths[clip["path"]])
+        cmd.extend(["-to", str(clip["end"] - seek), "-c", "copy", partial_path])
+
+    cut_clips = []
+    try:
+        returncode, stderr = await run_ffmpeg(cmd)
+        if returncode == 0:
+            for clip in clips:
+                partial_path = temp_paths[clip["path"]]
+                if _is_complete(partial_path):
+                    os.replace(partial_path, clip["path"])
+                    cut_clips.append(clip)
+    finally:
+        for partial_path in temp_paths.values():
+            partial_path.unlink(missing_ok=True)
+
+    # Only the tail of ffmpeg's log is useful for diagnosing the failure
+    if returncode != 0:
+        failed_clips = clips
+        logger.error(
+            "Error downloading clips %s: ffmpeg exited with %d\nSTDERR: %s",
+            [clip["index"] for clip in clips],
+            returncode,
+            stderr.decode(errors="replace")[-4096:] or "None",
+        )
     else:
-        # Handle regular SearchData format
-        processed_clips = clips_data[:num_clips]
-
-    processed_clips = processed_clips[
-        :num_clips
-    ]  # Ensure we only take requested number
+        cut_paths = {clip["path"] for clip in cut_clips}
+        failed_clips = [clip for clip in clips if clip["path"] not in cut_paths]
+        if not failed_clips:
+            return cut_clips
+        logger.error(
+            "Error downloading clips %s: ffmpeg wrote no output\nSTDERR: %s",
+            [clip["index"] for clip in failed_clips],
+            stderr.decode(errors="replace")[-4096:] or "None",
+        )
+
+    if len(clips) > 1:
+        # One bad range can abort or empty the outputs of the whole pass, so
+        # retry the failed clips one by one and let the others still succeed
+        results = await asyncio.gather(
+            *(_cut_hls_clips(m3u8_url, [clip]) for clip in failed_clips)
+        )
+        cut_clips.extend(chain.from_iterable(results))
+    return cut_clips
+
+
+def _cache_path(video_id: Optional[str], start_time, end_time) -> Optional[Path]:
+    """Return the cache entry for a clip of a video, or None if it can't be cached"""
+    if not video_id or CACHE_DIR is None:
+        return None
+    # The HLS URL can change between retrievals, so the cache is keyed on the
+    # video itself
+    cache_key = f"{video_id}:{start_time}:{end_time}"
+    return CACHE_DIR / (
+        hashlib.blake2b(cache_key.encode(), digest_size=8).hexdigest() + ".mp4"
+    )
+
+
+def _prune_cache() -> None:
+    """Evict the least recently used cached clips until the cache fits its limit"""
+    entries = []
+    for path in CACHE_DIR.iterdir():
+        # Skip the temporary files of links still being made
+        if path.name.startswith("."):
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total_size -= size
+
+
+def _store_in_cache(cache_paths: dict[Path, Path]) -> None:
+    """Store downloaded clips under their cache entries, then prune the cache"""
+    # Touch the clips already cached so eviction goes by last use rather than
+    # first download
+    for output_path, cache_path in cache_paths.items():
+        if not _is_complete(output_path):
+            continue
+        try:
+            if cache_path.exists():
+                os.utime(cache_path)
+            else:
+                _link_or_copy(output_path, cache_path)
+        except OSError as e:
+            logger.warning("Error caching clip %s: %s", output_path, e)
+    _prune_cache()
+
+
+async def _download_hls_clips(
+    m3u8_url: str, video_id: Optional[str], indexed_clips: list[tuple[int, dict]]
+) -> tuple[list[dict], list[dict]]:
+    """Cut (index, clip) pairs from a video's stream, returning (downloaded, failed)"""
+    downloaded_clips = []
+    # Output path -> clips waiting on it; a range requested twice is cut once
+    pending_clips = defaultdict(list)
+    # Output path -> cache entry it should be stored under once downloaded
+    cache_paths = {}
 
-    # Download each clip
-    for i, clip in enumerate(processed_clips):
+    for i, clip in indexed_clips:
         start_time = clip.get("start")
         end_time = clip.get("end")
 
         if start_time is None or end_time is None:
             continue
 
-        # Generate unique filename
-        clip_id = str(uuid.uuid4())[:8]
-        output_path = host_dir / f"clip_{clip_id}_{i}.mp4"
+        # Name the file after its source and range, so a retried or repeated
+        # request finds the clip it already downloaded
+        clip_id = hashlib.blake2b(
+            f"{m3u8_url}|{start_time}|{end_time}".encode(), digest_size=8
+        ).hexdigest()
+        output_path = HOST_DIR / f"clip_{clip_id}.mp4"
+
+        downloaded_clip = {
+            "index": i,
+            "start": start_time,
+            "end": end_time,
+            "path": str(output_path),
+            "clip_data": clip,
+        }
+
+        if output_path in pending_clips:
+            pending_clips[output_path].append(downloaded_clip)
+            continue
 
-        try:
-            # Use ffmpeg to download and trim the clip
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-ss",
-                str(start_time),
-                "-to",
-                str(end_time),
-                "-i",
-                m3u8_url,
-                "-c",
-                "copy",
-                str(output_path),
-            ]
-
-            subprocess.run(cmd, check=True, capture_output=True)
-
-            downloaded_clips.append(
-                {
-                    "index": i,
-                    "start": start_time,
-                    "end": end_time,
-                    "path": str(output_path),
-                    "clip_data": clip,
-                }
+        # Only clips of the video being cut may be cached; a clip of another
+        # video is still cut from this stream but must not be stored as its own
+        cache_path = None
+        if video_id and clip.get("video_id") == video_id:
+            cache_path = _cache_path(video_id, start_time, end_time)
+        if _is_complete(output_path):
+            downloaded_clips.append(downloaded_clip)
+        elif cache_path is not None and cache_path.exists():
+            # Linking can fall back to a full copy, so keep it off the event loop
+            await asyncio.to_thread(_link_or_copy, cache_path, output_path)
+            downloaded_clips.append(downloaded_clip)
+        else:
+            pending_clips[output_path].append(downloaded_clip)
+        if cache_path is not None:
+            cache_paths[output_path] = cache_path
+
+    # Nearby clips share one pass over the stream, while clips far apart get
+    # their own process so ffmpeg never downloads the gap between them
+    batches = _batch_clips([clips[0] for clips in pending_clips.values()])
+    results = await asyncio.gather(
+        *(_cut_hls_clips(m3u8_url, batch) for batch in batches)
+    )
+    cut_paths = {clip["path"] for clip in chain.from_iterable(results)}
+
+    failed_clips = []
+    for output_path, clips in pending_clips.items():
+        if str(output_path) not in cut_paths:
+            failed_clips.extend(
+                {key: value for key, value in clip.items() if key != "path"}
+                for clip in clips
             )
+            continue
+        downloaded_clips.extend(clips)
 
-        except subprocess.CalledProcessError as e:
-            print(f"Error downloading clip {i}: {e}")
-            print(f"STDERR: {e.stderr.decode() if e.stderr else 'None'}")
+    # Copying into the cache and scanning it to prune are blocking file work
+    if cache_paths:
+        await asyncio.to_thread(_store_in_cache, cache_paths)
 
-    return {
-        "status": "success",
-        "clips_requested": num_clips,
-        "clips_downloaded": len(downloaded_clips),
-        "clips": downloaded_clips,
-    }
+    def by_index(clip: dict) -> int:
+        return clip["index"]
+
+    return sorted(downloaded_clips, key=by_index), sorted(failed_clips, key=by_index)
+
+
+def _download_setup_error() -> Optional[dict]:
+    """Return the error a download tool should report if it can't run, else None"""
+    if HOST_DIR is None:
+        return {
+            "status": "error",
+            "message": "TWELVELABS_MCP_BASE_PATH environment variable is required",
+        }
+    if HOST_DIR_ERROR:
+        return {"status": "error", "message": HOST_DIR_ERROR}
+    if not ffmpeg_bin:
+        return {"status": "error", "message": "ffmpeg was not found on PATH"}
+    return None
+
+
+@mcp.tool(
+    description="""Download clips from a TwelveLabs search result, using the mcp_tool @retrieve_video and @search results
+    """
+)
+async def download_clips(num_clips: int, search_result: dict, video_info: dict) -> dict:
+    async with _TOOL_SEM:
+        if error := _download_setup_error():
+            return error
+
+        # Get m3u8 URL from video_info
+        if not video_info.get("hls") or not video_info["hls"].get("video_url"):
+            return {
+                "status": "error",
+                "message": "No HLS video URL found in video_info",
+            }
+
+        m3u8_url = video_info["hls"]["video_url"]
+        # retrieve_video serializes the video ID as "id"; the API itself uses "_id"
+        video_id = video_info.get("id") or video_info.get("_id")
+
+        # Process search results
+        processed_clips = _flatten_clips(search_result.get("data", []), num_clips)
+        downloaded_clips, failed_clips = await _download_hls_clips(
+            m3u8_url, video_id, list(enumerate(processed_clips))
+        )
+
+        return {
+            "status": "success",
+            "clips_requested": num_clips,
+            "clips_downloaded": len(downloaded_clips),
+            "clips": downloaded_clips,
+            "clips_failed": failed_clips,
+        }
+
+
+@mcp.tool(
+    description="""Search an index and download the matching clips in one call, without separate @search and @retrieve_video round trips
+    Args:
+        index_id: The unique identifier of the index to search
+        query_text: The text query to search for
+        num_clips: Number of clips to download
+        options: List of search options (e.g. ["visual", "audio"])
+        threshold: Filter by confidence level ("high", "medium", "low", "none")
+    Returns:
+        A dictionary with the downloaded clip paths, time ranges and search data
+    """
+)
+async def search_and_download(
+    index_id: str,
+    query_text: str,
+    num_clips: int = 5,
+    options: list[str] = ["visual", "audio"],
+    threshold: Optional[str] = "low",
+) -> dict:
+    async with _TOOL_SEM:
+        if error := _download_setup_error():
+            return error
+
+        try:
+            params = {
+                "index_id": index_id,
+                "query_text": query_text,
+                "options": _canonical_options(tuple(options)),
+                "group_by": "clip",
+                "page_limit": min(max(num_clips, 1), 50),
+            }
+            if threshold:
+                params["threshold"] = threshold
+
+            results: models.SearchResult = await asyncio.to_thread(
+                get_client().search.query, **params
+            )
+            processed_clips = _flatten_clips(results.model_dump()["data"], num_clips)
+
+            # Clips may span several videos; each needs its own HLS URL
+            clips_by_video = defaultdict(list)
+            for i, clip in enumerate(processed_clips):
+                clips_by_video[clip["video_id"]].append((i, clip))
+
+            async def download_video_clips(
+                video_id: str, indexed_clips: list[tuple[int, dict]]
+            ) -> tuple[list[dict], list[dict]]:
+                # A video that can't be retrieved or cut fails only its own
+                # clips rather than the whole call
+                try:
+                    video_info: models.Video = await asyncio.to_thread(
+                        get_client().index.video.retrieve, index_id, video_id
+                    )
+                    if video_info.hls and video_info.hls.video_url:
+                        return await _download_hls_clips(
+                            video_info.hls.video_url, video_id, indexed_clips
+                        )
+                    logger.warning("No HLS video URL found for video %s", video_id)
+                except Exception as e:
+                    logger.exception(
+                        "Error downloading clips of video %s: %s", video_id, e
+                    )
+                failed_clips = [
+                    {
+                        "index": i,
+                        "start": clip.get("start"),
+                        "end": clip.get("end"),
+                        "clip_data": clip,
+                    }
+                    for i, clip in indexed_clips
+                ]
+                return [], failed_clips
+
+            # Retrieve every video concurrently and start cutting each one as soon
+            # as its URL arrives, rather than retrieving and downloading serially
+            results_by_video = await asyncio.gather(
+                *(
+                    download_video_clips(video_id, indexed_clips)
+                    for video_id, indexed_clips in clips_by_video.items()
+                )
+            )
+            downloaded_clips = sorted(
+                chain.from_iterable(downloaded for downloaded, _ in results_by_video),
+                key=lambda clip: clip["index"],
+            )
+            failed_clips = sorted(
+                chain.from_iterable(failed for _, failed in results_by_video),
+                key=lambda clip: clip["index"],
+            )
+
+            return {
+                "status": "success",
+                "clips_requested": num_clips,
+                "clips_downloaded": len(downloaded_clips),
+                "clips": downloaded_clips,
+                "clips_failed": failed_clips,
+            }
+        except Exception as e:
+            logger.exception("Error in search_and_download: %s", e)
+            return {"status": "error", "message": str(e)}
 
 
 if __name__ == "__main__":
     # Start the server
-    print("Starting TwelveLabs MCP server...")
+    logger.info("Starting TwelveLabs MCP server...")
     mcp.run()
@@ -1,19 +1,102 @@
 from twelvelabs import models
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Tuple
+import asyncio
 import os
-import subprocess
-import threading
+import shutil
 import tempfile
+import time
+import uuid
 import logging
-
-
-def download_clips(search_data: models.SearchResult, num_clips: int) -> List[str]:
+import weakref
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# StreamReader limit for ffmpeg pipes. This raises the longest line readline()
+# accepts and the buffer size at which the transport pauses reading; the size
+# of each read from the pipe is fixed by asyncio
+PIPE_BUFFER_LIMIT = 1024 * 1024
+
+# Cap on concurrently running ffmpeg processes, so parallel downloads don't
+# oversubscribe the CPU
+FFMPEG_PARALLELISM = (
+    int(os.environ.get("TWELVELABS_FFMPEG_PARALLELISM") or 0) or os.cpu_count() or 4
+)
+# Event loop -> semaphore enforcing FFMPEG_PARALLELISM, see ffmpeg_semaphore()
+_ffmpeg_semaphores = weakref.WeakKeyDictionary()
+
+# Seconds a looked-up video URL is reused before it is fetched again, since
+# signed stream URLs expire
+VIDEO_URL_TTL = 300.0
+# Most video URLs kept at once; the least recently used are evicted first
+VIDEO_URL_CACHE_SIZE = 1024
+# (index_id, video_id) -> (expiry time, video URL) in least to most recently
+# used order, see get_video_url()
+_video_urls = OrderedDict()
+
+# HTTP protocol options: reconnect on dropped connections, and keep the
+# connection alive when seeking within a file. For an HLS input they only
+# govern the playlist request, not the segment fetches
+_HTTP_INPUT_OPTIONS = [
+    "-reconnect",
+    "1",
+    "-reconnect_streamed",
+    "1",
+    "-reconnect_delay_max",
+    "2",
+    "-multiple_requests",
+    "1",
+]
+
+# HLS demuxer options for segment fetches: reuse one persistent connection
+# and request the next segment while the current one is still downloading
+_HLS_INPUT_OPTIONS = [
+    "-http_persistent",
+    "1",
+    "-http_multiple",
+    "1",
+]
+
+# Output options for clips transcoded to H.264/AAC for frame-accurate cuts
+_REENCODE_OPTIONS = [
+    "-c:v",
+    "libx264",  # Video codec
+    "-b:v",
+    "2M",  # Video bitrate
+    "-maxrate",
+    "2M",  # Max bitrate
+    "-bufsize",
+    "4M",  # Buffer size
+    "-r",
+    "30",  # Frame rate
+    "-pix_fmt",
+    "yuv420p",  # Pixel format for compatibility
+    "-c:a",
+    "aac",  # Audio codec
+    "-b:a",
+    "192k",  # Audio bitrate
+    "-ar",
+    "44100",  # Audio sample rate
+    "-preset",
+    "medium",  # Encoding speed/quality tradeoff
+    "-crf",
+    "23",  # Quality level
+]
+
+
+async def download_clips(
+    search_data: models.SearchResult, num_clips: int, reencode: bool = False
+) -> List[str]:
     """
     Download video clips from search results using ffmpeg.
 
     Args:
         search_data: SearchResult object from the twelvelabs API
         num_clips: Maximum number of clips to download
+        reencode: Transcode to H.264/AAC for frame-accurate cuts instead of
+            stream copying (cuts then snap to the nearest keyframe)
 
     Returns:
         List of paths to downloaded video clips
@@ -32,37 +115,57 @@ def download_clips(search_data: models.SearchResult, num_clips: int) -> List[str
     clips_data = clips_data[:num_clips]
 
     if not clips_data:
-        print("No clips found in search results")
+        logger.info("No clips found in search results")
         return []
 
     # Create output directory
     output_dir = os.path.join(tempfile.gettempdir(), "twelvelabs_clips")
     os.makedirs(output_dir, exist_ok=True)
 
-    downloaded_clips = []
+    index_id = search_data.pool.index_id
 
-    # Download each clip
+    # Group clips by source video so each video only needs one ffmpeg pass
+    clips_by_video = defaultdict(list)
     for i, clip in enumerate(clips_data):
-        # Get video info using the index_id and video_id
-        index_id = search_data.pool.index_id
-        video_id = clip.video_id
+        # Create output filename
+        filename = f"clip_{i + 1}_{clip.video_id}_{clip.start:.2f}_{clip.end:.2f}.mp4"
+        output_path = os.path.join(output_dir, filename)
+        clips_by_video[clip.video_id].append((i, clip.start, clip.end, output_path))
 
+    async def fetch_video_clips(
+        video_id: str, clips: List[Tuple[int, float, float, str]]
+    ) -> List[Tuple[int, str]]:
         # Get video URL (this would typically come from an API call)
         video_url = get_video_url(index_id, video_id)
         if not video_url:
-            print(f"[ERROR] Could not get URL for video ID: {video_id}")
-            continue
+            logger.error("Could not get URL for video ID: %s", video_id)
+            return []
 
-        # Create output filename
-        filename = f"clip_{i + 1}_{clip.video_id}_{clip.start:.2f}_{clip.end:.2f}.mp4"
-        output_path = os.path.join(output_dir, filename)
+        ranges = [(start, end, path) for _, start, end, path in clips]
+        if len(ranges) > 1 and not _ranges_overlap(ranges):
+            extracted = set(
+                await extract_clips_segment(video_url, ranges, output_dir, reencode)
+            )
+            return [(i, path) for i, _, _, path in clips if path in extracted]
 
-        # Download the clip
-        success = download_clip(video_url, clip.start, clip.end, output_path)
-        if success:
-            downloaded_clips.append(output_path)
+        # Overlapping ranges can't be expressed as segment cuts
+        results = await asyncio.gather(
+            *(
+                download_clip(video_url, start, end, path, reencode)
+                for _, start, end, path in clips
+            )
+        )
+        return [(i, path) for (i, _, _, path), ok in zip(clips, results) if ok]
 
-    print(f"Downloaded {len(downloaded_clips)} of {len(clips_data)} clips")
+    # Download videos concurrently; ffmpeg launches are bounded by ffmpeg_semaphore()
+    results = await asyncio.gather(
+        *(fetch_video_clips(vid, clips) for vid, clips in clips_by_video.items())
+    )
+    downloaded_clips = [
+        path for _, path in sorted(item for items in results for item in items)
+    ]
+
+    logger.info("Downloaded %d of %d clips", len(downloaded_clips), len(clips_data))
     return downloaded_clips
 
 
@@ -70,7 +173,9 @@ def get_video_url(index_id: str, video_id: str) -> Optional[str]:
     """
     Get the video URL for a given index_id and video_id.
     This is a placeholder - in a real implementation, you would
-    fetch this from the TwelveLabs API.
+    fetch this from the TwelveLabs API. URLs are cached per
+    (index_id, video_id) for VIDEO_URL_TTL seconds so repeated lookups
+    skip the round trip; failed lookups are not cached.
 
     Args:
         index_id: The index ID from the search results
@@ -82,118 +187,306 @@ def get_video_url(index_id: str, video_id: str) -> Optional[str]:
     # This is where you would make an API call to get the video URL
     # For example, using the client to get video details
     # For now, we'll return a placeholder value
-    print(f"Getting video URL for index_id={index_id}, video_id={video_id}")
+    key = (index_id, video_id)
+    now = time.monotonic()
+    cached = _video_urls.get(key)
+    if cached is not None and cached[0] > now:
+        _video_urls.move_to_end(key)
+        return cached[1]
+
+    logger.debug("Getting video URL for index_id=%s, video_id=%s", index_id, video_id)
 
     # Replace this with actual API call to get the video URL
-    return f"https://example.com/videos/{video_id}.mp4"  # Placeholder
+    video_url = f"https://example.com/videos/{video_id}.mp4"  # Placeholder
 
+    if video_url:
+        _video_urls[key] = (now + VIDEO_URL_TTL, video_url)
+        _video_urls.move_to_end(key)
+        while len(_video_urls) > VIDEO_URL_CACHE_SIZE:
+            _video_urls.popitem(last=False)
+    return video_url
 
-def download_clip(
-    video_url: str, start_time: float, end_time: float, output_path: str
-) -> bool:
+
+def ffmpeg_semaphore() -> asyncio.Semaphore:
     """
-    Download a specific portion of a video using ffmpeg.
+    Return the semaphore bounding concurrent ffmpeg processes.
+
+    An asyncio.Semaphore binds to the first event loop that waits on it, so
+    one is kept per running loop; callers may drive this module from several
+    asyncio.run() calls.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _ffmpeg_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _ffmpeg_semaphores[loop] = asyncio.Semaphore(FFMPEG_PARALLELISM)
+    return semaphore
+
+
+async def run_ffmpeg(cmd: List[str]) -> Tuple[int, bytes]:
+    """
+    Run an ffmpeg command under ffmpeg_semaphore().
+
+    If the caller is cancelled, ffmpeg is killed and reaped rather than left
+    running in the background.
 
     Args:
-        video_url: URL of the source video
-        start_time: Start timestamp in seconds
-        end_time: End timestamp in seconds
-        output_path: Path to save the downloaded clip
+        cmd: The ffmpeg command line
 
     Returns:
-        True if download was successful, False otherwise
+        The exit code and everything ffmpeg wrote to stderr
     """
-    # Skip if file already exists
-    if os.path.exists(output_path):
-        print(f"[INFO] Clip already exists: {os.path.basename(output_path)}")
-        return True
+    async with ffmpeg_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            limit=PIPE_BUFFER_LIMIT,
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+    return process.returncode, stderr
 
-    try:
-        print(f"[INFO] Downloading clip: {os.path.basename(output_path)}")
 
-        # Calculate duration and optimize seeking strategy
-        duration = end_time - start_time
+def temp_path(path: Path) -> Path:
+    """
+    Return a unique hidden sibling of path to write to before renaming it.
+
+    The suffix is kept so ffmpeg still picks the muxer from the file name.
+    """
+    return path.with_name(f".{path.stem}.{uuid.uuid4().hex[:8]}.part{path.suffix}")
+
 
-        # For more accurate seeking:
-        # 1. First seek (before input) to ~5 seconds before desired start (fast but less accurate)
-        # 2. Then use a second seek (after input) for precise position (slower but accurate)
-        offset = 5
-        input_seek = max(0, start_time - offset)
-        accurate_seek = start_time - input_seek
+def ffmpeg_input_options(video_url: str) -> List[str]:
+    """Return the ffmpeg input options to use for the given source URL."""
+    # ffmpeg can fail on input options that neither the protocol nor the
+    # demuxer consumes, so only pass the ones that apply to this source
+    if not video_url.startswith(("http://", "https://")):
+        return []
+    if urlparse(video_url).path.endswith(".m3u8"):
+        return _HTTP_INPUT_OPTIONS + _HLS_INPUT_OPTIONS
+    return _HTTP_INPUT_OPTIONS
+
+
+def _ranges_overlap(ranges: List[Tuple[float, float, str]]) -> bool:
+    """Return True if any two (start, end, path) ranges overlap in time."""
+    ordered = sorted(ranges)
+    return any(nxt[0] < cur[1] for cur, nxt in zip(ordered, ordered[1:]))
 
-        # Build ffmpeg command
+
+def _segment_plan(
+    ranges: List[Tuple[float, float, str]],
+) -> Tuple[List[float], List[Tuple[int, str]]]:
+    """
+    Plan the segment muxer split points for a set of clip ranges.
+
+    Segment i spans [segment_times[i - 1], segment_times[i]), so a range
+    starting at segment_times[k - 1] ends up in segment k. No split is added
+    at t=0 or where a range starts right at the previous one's end.
+
+    Args:
+        ranges: (start_time, end_time, output_path) tuples, sorted and
+            non-overlapping
+
+    Returns:
+        The split times, and (segment_index, output_path) for every range
+    """
+    segment_times = []
+    segment_targets = []
+    for start, end, path in ranges:
+        if start > 0 and (not segment_times or segment_times[-1] != start):
+            segment_times.append(start)
+        segment_targets.append((len(segment_times), path))
+        segment_times.append(end)
+    return segment_times, segment_targets
+
+
+async def extract_clips_segment(
+    video_url: str,
+    ranges: List[Tuple[float, float, str]],
+    out_dir: str,
+    reencode: bool = False,
+) -> List[str]:
+    """
+    Extract several non-overlapping clips from one video in a single ffmpeg pass.
+
+    The segment muxer walks the input once and splits it at every range
+    boundary; the segments that correspond to the requested ranges are then
+    moved to their output paths and the gaps between them are discarded.
+
+    With stream copying the muxer can only split on keyframes, so every clip
+    starts and ends at the first keyframe at or after its requested times.
+    Reencoding forces keyframes at the range boundaries so the cuts are exact.
+
+    Args:
+        video_url: URL of the source video
+        ranges: (start_time, end_time, output_path) tuples, non-overlapping
+        out_dir: Directory used for the intermediate segment files
+        reencode: Transcode to H.264/AAC for frame-accurate cuts instead of
+            stream copying
+
+    Returns:
+        List of paths to the extracted clips
+    """
+    extracted = [path for _, _, path in ranges if os.path.exists(path)]
+    pending = sorted(r for r in ranges if not os.path.exists(r[2]))
+    if not pending:
+        return extracted
+
+    segment_times, segment_targets = _segment_plan(pending)
+    split_times = ",".join(str(t) for t in segment_times)
+    if reencode:
+        codec_options = [*_REENCODE_OPTIONS, "-force_key_frames", split_times]
+    else:
+        codec_options = ["-c", "copy"]  # Copy streams without transcoding
+
+    segment_dir = tempfile.mkdtemp(prefix="segments_", dir=out_dir)
+    try:
+        logger.info("Extracting %d clips in one pass from %s", len(pending), video_url)
         cmd = [
             "ffmpeg",
-            "-ss",
-            str(input_seek),  # Initial seek (faster)
+            *ffmpeg_input_options(video_url),
             "-i",
             video_url,  # Input file
-            "-ss",
-            str(accurate_seek),  # Fine-tune seek (accurate)
-            "-t",
-            str(duration),  # Duration
-            "-c:v",
-            "libx264",  # Video codec
-            "-b:v",
-            "2M",  # Video bitrate
-            "-maxrate",
-            "2M",  # Max bitrate
-            "-bufsize",
-            "4M",  # Buffer size
-            "-r",
-            "30",  # Frame rate
-            "-pix_fmt",
-            "yuv420p",  # Pixel format for compatibility
-            "-c:a",
-            "aac",  # Audio codec
-            "-b:a",
-            "192k",  # Audio bitrate
-            "-ar",
-            "44100",  # Audio sample rate
-            "-preset",
-            "medium",  # Encoding speed/quality tradeoff
-            "-crf",
-            "23",  # Quality level
-            "-movflags",
-            "+faststart",  # Optimize for web playback
+            "-to",
+            str(segment_times[-1]),  # Stop reading after the last clip
+            *codec_options,
+            "-f",
+            "segment",  # Split the output at the given timestamps
+            "-segment_times",
+            split_times,
+            "-reset_timestamps",
+            "1",  # Start every segment at t=0
             "-y",  # Overwrite output
-            output_path,
+            os.path.join(segment_dir, "out_%03d.mp4"),
         ]
+        exit_code, stderr = await run_ffmpeg(cmd)
+        if exit_code != 0:
+            # Only the tail of ffmpeg's log is useful for diagnosing the failure
+            logger.error(
+                "Failed to extract clips from %s (exit code: %d)\nSTDERR: %s",
+                video_url,
+                exit_code,
+                stderr.decode(errors="replace")[-4096:] or "None",
+            )
+            return extracted
 
-        # Execute ffmpeg process
-        process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
-        )
+        for segment, path in segment_targets:
+            segment_path = os.path.join(segment_dir, f"out_{segment:03d}.mp4")
+            if os.path.exists(segment_path):
+                os.replace(segment_path, path)
+                extracted.append(path)
+        return extracted
 
-        # Function to handle process output
-        def log_output(stream, prefix):
-            for line in stream:
-                if "error" in line.lower() or "warning" in line.lower():
-                    print(f"[{prefix}] {line.strip()}")
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
 
-        # Start threads to handle stdout and stderr
-        stdout_thread = threading.Thread(
-            target=log_output, args=(process.stdout, "FFMPEG"), daemon=True
-        )
-        stderr_thread = threading.Thread(
-            target=log_output, args=(process.stderr, "FFMPEG"), daemon=True
-        )
 
-        stdout_thread.start()
-        stderr_thread.start()
+async def download_clip(
+    video_url: str,
+    start_time: float,
+    end_time: float,
+    output_path: str,
+    reencode: bool = False,
+) -> bool:
+    """
+    Download a specific portion of a video using ffmpeg.
+
+    Args:
+        video_url: URL of the source video
+        start_time: Start timestamp in seconds
+        end_time: End timestamp in seconds
+        output_path: Path to save the downloaded clip
+        reencode: Transcode to H.264/AAC for frame-accurate cuts instead of
+            stream copying (cuts then snap to the nearest keyframe)
+
+    Returns:
+        True if download was successful, False otherwise
+    """
+    # Skip if file already exists
+    if os.path.exists(output_path):
+        logger.info("Clip already exists: %s", os.path.basename(output_path))
+        return True
 
-        # Wait for process to complete
-        exit_code = process.wait()
+    # Write under a temporary name so a failed or cancelled run never leaves a
+    # partial file that the exists check above would take for a finished clip
+    partial_path = str(temp_path(Path(output_path)))
+    try:
+        logger.info("Downloading clip: %s", os.path.basename(output_path))
+
+        duration = end_time - start_time
 
+        if reencode:
+            # For more accurate seeking:
+            # 1. First seek (before input) to ~5 seconds before desired start (fast but less accurate)
+            # 2. Then use a second seek (after input) for precise position (slower but accurate)
+            offset = 5
+            input_seek = max(0, start_time - offset)
+            accurate_seek = start_time - input_seek
+
+            # Build ffmpeg command
+            cmd = [
+                "ffmpeg",
+                "-nostats",  # No carriage-return progress lines on stderr
+                "-ss",
+                str(input_seek),  # Initial seek (faster)
+                *ffmpeg_input_options(video_url),
+                "-i",
+                video_url,  # Input file
+                "-ss",
+                str(accurate_seek),  # Fine-tune seek (accurate)
+                "-t",
+                str(duration),  # Duration
+                *_REENCODE_OPTIONS,
+                "-movflags",
+                "+faststart",  # Optimize for web playback
+                "-y",  # Overwrite output
+                partial_path,
+            ]
+        else:
+            # The source is already H.264, so a single input seek plus a
+            # stream copy avoids decoding and encoding every frame
+            cmd = [
+                "ffmpeg",
+                "-nostats",  # No carriage-return progress lines on stderr
+                "-ss",
+                str(start_time),  # Input seek (jumps straight to the segment)
+                *ffmpeg_input_options(video_url),
+                "-i",
+                video_url,  # Input file
+                "-t",
+                str(duration),  # Duration
+                "-c",
+                "copy",  # Copy streams without transcoding
+                "-movflags",
+                "+faststart",  # Optimize for web playback
+                "-y",  # Overwrite output
+                partial_path,
+            ]
+
+        exit_code, stderr = await run_ffmpeg(cmd)
         if exit_code == 0:
-            print(f"[SUCCESS] Downloaded clip: {os.path.basename(output_path)}")
+            os.replace(partial_path, output_path)
+            logger.info("Downloaded clip: %s", os.path.basename(output_path))
             return True
         else:
-            print(
-                f"[ERROR] Failed to download clip: {os.path.basename(output_path)} (exit code: {exit_code})"
+            # Only the tail of ffmpeg's log is useful for diagnosing the failure
+            logger.error(
+                "Failed to download clip: %s (exit code: %d)\nSTDERR: %s",
+                os.path.basename(output_path),
+                exit_code,
+                stderr.decode(errors="replace")[-4096:] or "None",
             )
             return False
 
     except Exception as e:
-        print(f"[ERROR] Exception during download: {str(e)}")
+        logger.error("Exception during download: %s", e)
         return False
+
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)